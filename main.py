@@ -3,14 +3,31 @@ from selenium.webdriver.firefox.service import Service
 from selenium.webdriver.firefox.options import Options
 from webdriver_manager.firefox import GeckoDriverManager
 from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.by import By
-from urllib.request import urlopen
+from selenium.webdriver.common.keys import Keys
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dateutil.rrule import DAILY, rrule, MO, TU, WE, TH, FR
 from dateutil import parser
-from PIL import Image
+from selectolax.lexbor import LexborHTMLParser
+from urllib.parse import urljoin, urldefrag, urlsplit
+from pathlib import PurePosixPath
 from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import Manager
+from dataclasses import dataclass, astuple
+import io
+import json
+import logging
 import os
+import queue
+import shutil
+import tempfile
 import piexif
+import requests
+import urllib3
 
 EMAIL = os.getenv('EMAIL')
 PASSWORD = os.getenv('PASSWORD')
@@ -19,124 +36,562 @@ DAY_FROM = os.getenv('DAY_FROM')  # e.g. "2022-12-31"
 DAY_TO = os.getenv('DAY_TO')  # e.g  "2022-12-31"
 GROUP_ID = os.getenv('GROUP_ID')  # e.g "11"
 
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')  # e.g. "DEBUG" to list every downloaded file, "WARNING" for errors only
+LOGGER = logging.getLogger("verbose-journey")
+
 OUTPUT_DIR = "/data"
-JOURNAL_ENTRIES_COUNT = 0
-GALLERY_IMAGES_COUNT = 0
-ATTACHMENTS_FILES_COUNT = 0
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOADS', '8'))  # number of files downloaded at the same time
+COPY_BUFFER_SIZE = 1024 * 1024
+# read once at startup, the umask can only be read by setting it, so it is put back right away
+UMASK = os.umask(0)
+os.umask(UMASK)
+# file names come from urls, ':/*&' are dropped and the other characters windows shares reject are replaced,
+# all of it in a single translate pass
+FILENAME_TABLE = str.maketrans({**{c: '_' for c in '<>"\\|?' + ''.join(map(chr, range(32)))},
+                                **{c: None for c in ':/*&'}})
+FILENAME_MAX_LENGTH = 200  # in utf-8 bytes, leaves room for the date prefix, a counter and the .part name within 255
+FILENAME_EXTENSION_MAX_LENGTH = 16  # a longer suffix is rather part of the name than an extension
+EXIF_EXTENSIONS = frozenset({'.jpg', '.jpeg'})
+JPEG_MAGIC = b'\xff\xd8\xff'
+EXIF_DATETIME_TAG = piexif.ImageIFD.DateTime
+EXIF_DATETIME_ORIGINAL_TAG = piexif.ExifIFD.DateTimeOriginal
+EXIF_DATETIME_FORMAT = "%Y:%m:%d %H:%M:%S"
+BROWSERS = int(os.getenv('BROWSERS', '4'))  # number of Firefox instances scraping days in parallel
+WORKERS_CHECK_INTERVAL = 5  # seconds without found media after which the browser workers are checked for a crash
+GRID_URL = os.getenv('GRID_URL')  # e.g. "http://selenium-hub:4444/wd/hub"
+COOKIES_FILE = os.getenv('COOKIES_FILE', os.path.expanduser('~/.kita.cookies'))  # signed in session reused between runs
+HTTP_TIMEOUT = 30  # seconds to connect and between received bytes, a stalled connection would block a worker forever
+
+# keep-alive pools shared by all requests, a few hosts are cached so pages, photos served from a cdn and
+# attachments don't evict each other's connections
+HTTP_ADAPTER = HTTPAdapter(pool_connections=4, pool_maxsize=DOWNLOAD_WORKERS,
+                           max_retries=Retry(total=3, backoff_factor=0.3,
+                                             status_forcelist=(429, 500, 502, 503, 504)))
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount("https://", HTTP_ADAPTER)
+HTTP_SESSION.mount("http://", HTTP_ADAPTER)
+
+JOURNAL_ENTRY_SELECTOR = '.JournalEntrySmall'
+GALLERY_IMAGE_SELECTOR = 'div.carousel-item > img[loading="lazy"]'
+ATTACHMENT_SELECTOR = 'table > tbody > tr > td > a.btn-light.btn'
+MODAL_CLOSE_SELECTOR = 'a.new-modal__close'
+# every get_attribute is a separate WebDriver round trip, so collect the urls in a single script call instead
+ENTRIES_LINKS_SCRIPT = """
+return Array.from(document.querySelectorAll('%s'), e => {
+    const a = e.matches('a[href]') ? e : e.querySelector('a[href]');
+    // entries only opening the modal link back to the day view itself
+    if (!a || !a.href.startsWith('http') || a.href.split('#')[0] === location.href.split('#')[0]) {
+        return null;
+    }
+    return a.href;
+});
+""" % JOURNAL_ENTRY_SELECTOR
+ENTRY_MEDIA_SCRIPT = """
+return [
+    Array.from(document.querySelectorAll('%s'), e => e.src),
+    Array.from(document.querySelectorAll('%s'), e => e.href)
+];
+""" % (GALLERY_IMAGE_SELECTOR, ATTACHMENT_SELECTOR)
+
+
+@dataclass
+class Stats:
+    days: int = 0
+    entries: int = 0
+    images: int = 0
+    attachments: int = 0
+    downloaded: int = 0
+    duplicates: int = 0
+    failed: int = 0
+
+    def add(self, **counts):
+        for name, count in counts.items():
+            setattr(self, name, getattr(self, name) + count)
+
+    def __add__(self, other):
+        return Stats(*(a + b for a, b in zip(astuple(self), astuple(other))))
+
+
+@dataclass(frozen=True)
+class Day:
+    iso: str  # e.g. "2022-12-31"
+    exif: str  # e.g. "2022:12:31 00:00:00", written to the EXIF DateTime tag
+    view_url: str
+    file_prefix: str  # e.g. "/data/2022-12-31-", joined with the sanitized url name of every file of the day
+
+
+def page_loaded(driver):
+    return driver.execute_script("return document.readyState === 'complete'")
+
+
+def geckodriver_path():
+    path = os.getenv('GECKODRIVER_PATH')
+    if not path:
+        # resolve once, browser workers inherit the environment and skip the release check
+        path = GeckoDriverManager().install()
+        os.environ['GECKODRIVER_PATH'] = path
+    return path
 
 
 def setup_driver():
-    print("Setting up webdriver")
+    LOGGER.info("Setting up webdriver")
     options = Options()
     options.add_argument('--headless')
-    driver = webdriver.Firefox(service=Service(GeckoDriverManager().install()), options=options)
-    return driver
+    # media is downloaded outside of the browser, so pages only need their markup and styles
+    options.set_preference('permissions.default.image', 2)
+    options.set_preference('media.autoplay.default', 5)
+    options.set_preference('browser.display.use_document_fonts', 0)
+    options.set_preference('dom.webnotifications.enabled', False)
+    options.page_load_strategy = 'eager'
+    if GRID_URL:
+        driver = webdriver.Remote(command_executor=GRID_URL, options=options)
+    else:
+        driver = webdriver.Firefox(service=Service(geckodriver_path()), options=options)
+    # one wait per browser, the explicit waits are polled twice as often as selenium's default
+    return driver, WebDriverWait(driver=driver, timeout=10, poll_frequency=0.25)
 
 
-def login(driver, url, email, password):
-    print("Signing into {} with email {}".format(BASE_URL, EMAIL))
+def login(driver, wait, url, email, password):
+    LOGGER.info("Signing into %s with email %s", BASE_URL, EMAIL)
     driver.get(url)
     driver.find_element(By.ID, "user_email").send_keys(email)
-    driver.find_element(By.ID, "user_password").send_keys(password)
-    driver.find_element(By.NAME, "commit").click()
-    WebDriverWait(driver=driver, timeout=10).until(
-        lambda x: x.execute_script("return document.readyState === 'complete'")
-    )
+    password_field = driver.find_element(By.ID, "user_password")
+    # enter submits through the form's first submit button, the same request as clicking "commit"
+    password_field.send_keys(password + Keys.ENTER)
+    wait.until(EC.staleness_of(password_field))
+
+
+def share_session(session, session_state):
+    # pages and media are fetched outside of the browser, so they need the signed in cookies
+    for c in session_state['cookies']:
+        session.cookies.set(c['name'], c['value'], domain=c.get('domain'), path=c.get('path', '/'))
+    session.headers['User-Agent'] = session_state['user_agent']
 
 
 def work_week_days(start_date_string, end_date_string):
-    print("Getting work week days between {} and {}".format(DAY_FROM, DAY_TO))
+    LOGGER.info("Getting work week days between %s and %s", DAY_FROM, DAY_TO)
     start_date = parser.parse(start_date_string)
     end_date = parser.parse(end_date_string)
     return rrule(DAILY, dtstart=start_date, until=end_date, byweekday=(MO, TU, WE, TH, FR))
 
 
-def navigate_to_day(driver, day):
-    day_string = day.strftime("%Y-%m-%d")
-    print("Navigating to {} day view for group {}".format(day_string, GROUP_ID))
-    day_view_url = "{}/groups/{}/calendar/{}/day".format(BASE_URL, GROUP_ID, day_string)
+def plan_days(start_date_string, end_date_string):
+    # day view urls and date strings are built upfront, so neither scraping nor downloading formats dates again
+    plan = []
+    for day in work_week_days(start_date_string, end_date_string):
+        day_string = day.date().isoformat()
+        plan.append(Day(day_string, day.strftime(EXIF_DATETIME_FORMAT),
+                        "{}/groups/{}/calendar/{}/day".format(BASE_URL, GROUP_ID, day_string),
+                        OUTPUT_DIR + "/" + day_string + "-"))
+    return plan
+
+
+def navigate_to_day(driver, wait, day_string, day_view_url):
+    LOGGER.info("\tNavigating to %s day view with the browser", day_string)
     driver.get(day_view_url)
-    WebDriverWait(driver=driver, timeout=10).until(
-        lambda x: x.execute_script("return document.readyState === 'complete'")
-    )
+    # days without entries have nothing to wait for, so fall back to the page load
+    wait.until(EC.any_of(EC.presence_of_element_located((By.CSS_SELECTOR, JOURNAL_ENTRY_SELECTOR)), page_loaded))
+
 
+def scrap_entry(driver):
+    return driver.execute_script(ENTRY_MEDIA_SCRIPT)
 
-def scrap_for_images_url(driver):
-    global JOURNAL_ENTRIES_COUNT, GALLERY_IMAGES_COUNT, ATTACHMENTS_FILES_COUNT
+
+def scrap_for_images_url(driver, wait):
     images_urls = []  # list of images urls from gallery modal
     attachments_urls = []  # list of files urls added as attachments to journal activity
-    entries = driver.find_elements(By.CLASS_NAME, 'JournalEntrySmall')
-    JOURNAL_ENTRIES_COUNT = JOURNAL_ENTRIES_COUNT + len(entries)
-    print("\tFound {} journal entries in the day view".format(len(entries)))
-    for e in entries:
-        e.click()
-        WebDriverWait(driver=driver, timeout=10).until(
-            lambda x: x.execute_script("return document.readyState === 'complete'")
-        )
-        photos_elements = driver.find_elements(By.XPATH,
-                                               "//div[contains(@class, 'carousel-item')]/img[@loading='lazy']")
-        for p in photos_elements:
-            images_urls.append(p.get_attribute("src"))
-        attachments = driver.find_elements(By.XPATH,
-                                           "//table/tbody/tr/td/a[contains(@class, 'btn-light') and contains(@class, 'btn')]")
-        for a in attachments:
-            attachments_urls.append(a.get_attribute("href"))
-        driver.find_element(By.XPATH, '//a[contains(@class, "new-modal__close")]').click()
-    print("\t\tFound {} images and {} attachments".format(len(images_urls), len(attachments_urls)))
-    GALLERY_IMAGES_COUNT = GALLERY_IMAGES_COUNT + len(images_urls)
-    ATTACHMENTS_FILES_COUNT = ATTACHMENTS_FILES_COUNT + len(attachments_urls)
+    entries_links = driver.execute_script(ENTRIES_LINKS_SCRIPT)
+    if all(entries_links):
+        # open every entry directly, saves the click and close round trips of the modal
+        for link in entries_links:
+            driver.get(link)
+            wait.until(page_loaded)
+            images, attachments = scrap_entry(driver)
+            images_urls.extend(images)
+            attachments_urls.extend(attachments)
+    else:
+        for e in driver.find_elements(By.CSS_SELECTOR, JOURNAL_ENTRY_SELECTOR):
+            e.click()
+            close = wait.until(EC.element_to_be_clickable((By.CSS_SELECTOR, MODAL_CLOSE_SELECTOR)))
+            images, attachments = scrap_entry(driver)
+            images_urls.extend(images)
+            attachments_urls.extend(attachments)
+            close.click()
+            wait.until(EC.invisibility_of_element(close))
+    return len(entries_links), images_urls, attachments_urls
+
+
+def entries_links_from_html(page_url, html):
+    links = []
+    for e in LexborHTMLParser(html).css(JOURNAL_ENTRY_SELECTOR):
+        a = e if e.tag == 'a' and 'href' in e.attributes else e.css_first('a[href]')
+        link = urljoin(page_url, a.attributes['href']) if a else None
+        # entries only opening the modal link back to the day view itself
+        if not link or not link.startswith("http") or urldefrag(link)[0] == urldefrag(page_url)[0]:
+            link = None
+        links.append(link)
+    return links
+
+
+def entry_media_from_html(page_url, html):
+    tree = LexborHTMLParser(html)
+    images = [urljoin(page_url, p.attributes['src']) for p in tree.css(GALLERY_IMAGE_SELECTOR)
+              if p.attributes.get('src')]
+    attachments = [urljoin(page_url, a.attributes['href']) for a in tree.css(ATTACHMENT_SELECTOR)
+                   if a.attributes.get('href')]
+    return images, attachments
+
+
+def scrap_over_http(day_view_url):
+    # a plain request and parse is much cheaper than a browser navigation, but only works for server rendered
+    # pages, so None is returned whenever the result does not prove it and the day is scraped with the browser
+    try:
+        response = HTTP_SESSION.get(day_view_url, timeout=HTTP_TIMEOUT)
+        if not response.ok or "/sessions/sign_in" in response.url:
+            return None
+        entries_links = entries_links_from_html(response.url, response.text)
+        if not entries_links or not all(entries_links):
+            return None
+        images_urls = []
+        attachments_urls = []
+        for link in entries_links:
+            response = HTTP_SESSION.get(link, timeout=HTTP_TIMEOUT)
+            # the session can expire mid run, an entry redirected to sign in would silently lose its media
+            if not response.ok or "/sessions/sign_in" in response.url:
+                return None
+            images, attachments = entry_media_from_html(response.url, response.text)
+            images_urls.extend(images)
+            attachments_urls.extend(attachments)
+    except requests.RequestException:
+        return None
+    if not images_urls and not attachments_urls:
+        return None
+    return len(entries_links), images_urls, attachments_urls
+
+
+def record_day(stats, entries_count, images_urls, attachments_urls):
+    LOGGER.info("\tFound %d journal entries in the day view", entries_count)
+    LOGGER.info("\t\tFound %d images and %d attachments", len(images_urls), len(attachments_urls))
+    stats.add(entries=entries_count, images=len(images_urls), attachments=len(attachments_urls))
     return images_urls + attachments_urls
 
 
-def download_images(day, urls):
+def media_file(url):
+    # both only depend on the url, so they are worked out once and reused when it is found again on other days
+    name = url.rsplit('/', 1)[-1].translate(FILENAME_TABLE)
+    encoded = name.encode()
+    if len(encoded) > FILENAME_MAX_LENGTH:
+        # file systems limit names in bytes, not characters, and the extension the file is opened by is kept
+        ext = PurePosixPath(urlsplit(url).path).suffix.translate(FILENAME_TABLE)
+        if len(ext.encode()) > FILENAME_EXTENSION_MAX_LENGTH:
+            ext = ''
+        name = encoded[:FILENAME_MAX_LENGTH - len(ext.encode())].decode(errors='ignore') + ext
+    return name, may_have_exif(url)
+
+
+def date_file(path, day, copied_from=None):
+    # piexif reads the whole file before rejecting it, the start of image marker tells upfront
+    with open(path, 'rb') as f:
+        if f.read(len(JPEG_MAGIC)) != JPEG_MAGIC:
+            return
+    try:
+        add_date_to_exif(path, day, copied_from)
+    except piexif.InvalidImageDataError:
+        pass  # not a JPEG, e.g. a pdf attachment, there is no EXIF to date
+    except Exception:
+        LOGGER.warning("\t\t\tError during exif parsing. Ignoring and proceeding.")
+
+
+def may_have_exif(url):
+    suffix = PurePosixPath(urlsplit(url).path).suffix.lower()
+    # piexif can only write into JPEGs, urls without an extension still get a try
+    return suffix in EXIF_EXTENSIONS or not suffix
+
+
+def date_jpeg_head(head, day, copied_from=None):
+    # the EXIF segment comes before the start of scan, so the first chunk of a JPEG can be dated before it is
+    # written and the file never has to be read back, None when the chunk is no JPEG or ends before the scan
+    if not head.startswith(JPEG_MAGIC):
+        return None
+    try:
+        dated = io.BytesIO()
+        piexif.insert(dated_exif(piexif.load(head), day, copied_from), head, dated)
+    except Exception:
+        return None  # left to date_file, which reports what can't be parsed
+    return dated.getvalue()
+
+
+def publish_file(path, day, source, size=None, dated=True, copied_from=None):
+    head = source.read(COPY_BUFFER_SIZE)
+    dated_head = date_jpeg_head(head, day, copied_from) if dated else None
+    if dated_head is not None:
+        if size:
+            size = size + len(dated_head) - len(head)
+        head = dated_head
+    # written and dated under a hidden .part name first, so an interrupted run never leaves a half written file,
+    # the name is unique so concurrent writers of the same path never share one
+    fd, part = tempfile.mkstemp(suffix=".part", prefix="." + os.path.basename(path) + ".", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb', COPY_BUFFER_SIZE) as f:
+            # mkstemp only lets the owner read it, published files get the mode open() would give them
+            os.fchmod(f.fileno(), 0o666 & ~UMASK)
+            if size and hasattr(os, 'posix_fallocate'):
+                # reserve the extents upfront instead of growing the file chunk by chunk, only an optimisation, so
+                # file systems without support or an overstated length still get the plain copy
+                try:
+                    os.posix_fallocate(f.fileno(), 0, size)
+                except OSError:
+                    pass
+            f.write(head)
+            shutil.copyfileobj(source, f, COPY_BUFFER_SIZE)
+            f.truncate()
+        if dated and dated_head is None:
+            date_file(part, day, copied_from)
+        os.replace(part, path)
+    except BaseException:
+        os.remove(part)
+        raise
+
+
+def download_file(day, url, path, dated):
+    try:
+        with HTTP_SESSION.get(url, stream=True, timeout=HTTP_TIMEOUT) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            # the length of an encoded body is not the size of the file
+            size = None if 'Content-Encoding' in response.headers else response.headers.get('Content-Length')
+            publish_file(path, day, response.raw, int(size) if size and size.isdigit() else None, dated)
+    except (requests.RequestException, urllib3.exceptions.HTTPError, OSError) as e:
+        LOGGER.warning("\t\t\tFailed to download %s: %s", url, e)
+        return None
+    LOGGER.debug("\t\t\tDownloaded %s to %s", url, path)
+    return path
+
+
+def copy_download(first_download, first_day, day, path, dated):
+    # the first download is submitted earlier, so it is already running when this waits for it, its file is dated
+    # for first_day and re-dated for this one
+    source = first_download.result()
+    if source is None:
+        return None
+    if path != source:
+        try:
+            with open(source, 'rb') as f:
+                publish_file(path, day, f, os.fstat(f.fileno()).st_size, dated, first_day)
+        except OSError as e:
+            LOGGER.warning("\t\t\tFailed to copy %s to %s: %s", source, path, e)
+            return None
+    return path
+
+
+def unique_path(path, taken):
+    # different urls can end in the same name, e.g. attachments all served from .../download, they are numbered
+    # instead of overwriting each other
+    stem, ext = os.path.splitext(path)
     counter = 1
-    for u in urls:
-        print("\t\tDownloading {}/{}".format(counter, len(urls)))
-        counter = counter + 1
-        with urlopen(u) as file:
-            content = file.read()
-        path = OUTPUT_DIR + "/" + day.strftime("%Y-%m-%d") + "-" + u.rsplit('/', 1)[-1]
-        with open(path, 'wb') as download:
-            download.write(content)
+    while path in taken:
+        counter += 1
+        path = "{}-{}{}".format(stem, counter, ext)
+    taken.add(path)
+    return path
+
+
+def download_media(media_queue, scrapers, stats):
+    # one pool for the whole run, downloads start with the first found url while the browsers keep scraping
+    producers = len(scrapers)
+    downloads = {}  # url -> future of its first download and its day, repeated urls are copied from it
+    files = {}  # url -> its sanitized file name and whether it may carry EXIF
+    paths = {}  # (day, url) -> the file it is published to
+    taken = set()
+    copies = []
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        while producers:
+            try:
+                item = media_queue.get(timeout=WORKERS_CHECK_INTERVAL)
+            except queue.Empty:
+                # a worker killed outright, e.g. out of memory, never sends its None but breaks the whole pool
+                if any(s.done() and isinstance(s.exception(), BrokenProcessPool) for s in scrapers):
+                    break
+                continue
+            if item is None:
+                producers = producers - 1
+                continue
+            day, url = item
+            if url not in files:
+                files[url] = media_file(url)
+            name, dated = files[url]
+            if (day, url) not in paths:
+                paths[day, url] = unique_path(day.file_prefix + name, taken)
+            if url in downloads:
+                copies.append(executor.submit(copy_download, *downloads[url], day, paths[day, url], dated))
+            else:
+                downloads[url] = executor.submit(download_file, day, url, paths[day, url], dated), day
+    # counted from the results once the pool is done, so the threads share no counters
+    downloaded = sum(1 for f, _ in downloads.values() if f.result())
+    duplicates = sum(1 for f in copies if f.result())
+    stats.add(downloaded=downloaded, duplicates=duplicates,
+              failed=len(downloads) + len(copies) - downloaded - duplicates)
+
+
+def dated_exif(exif_dict, day, copied_from=None):
+    exif_dict["0th"][EXIF_DATETIME_TAG] = day.exif
+    # photo libraries sort by the capture date, a camera's own one is more precise and kept when present, while
+    # a copy replaces the one its source was dated with for the day it was first found on
+    original = exif_dict["Exif"].get(EXIF_DATETIME_ORIGINAL_TAG)
+    if original is None or (copied_from is not None and original == copied_from.exif.encode()):
+        exif_dict["Exif"][EXIF_DATETIME_ORIGINAL_TAG] = day.exif
+    return piexif.dump(exif_dict)
+
+
+def add_date_to_exif(image, day, copied_from=None):
+    # patch only the APP1 segment in place, re-saving through PIL would decode and re-compress the photo
+    piexif.insert(dated_exif(piexif.load(image), day, copied_from), image)
+
+
+def session_valid(session_state, check_url):
+    with requests.Session() as session:
+        share_session(session, session_state)
         try:
-            add_date_to_exif(path, day)
-        except:
-            print("\t\t\tError during exif parsing. Ignoring and proceeding.")
+            response = session.get(check_url, timeout=HTTP_TIMEOUT)
+        except requests.RequestException:
+            return False
+    # an expired session is redirected to the sign in form
+    return response.ok and "/sessions/sign_in" not in response.url
+
+
+def stored_session():
+    try:
+        with open(COOKIES_FILE) as f:
+            # a file someone else owns may have been planted in a shared directory, its cookies are not ours
+            if os.fstat(f.fileno()).st_uid != os.getuid():
+                LOGGER.warning("Ignoring session stored in %s, it is owned by another user", COOKIES_FILE)
+                return None
+            session_state = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        LOGGER.warning("Ignoring session stored in %s: %s", COOKIES_FILE, e)
+        return None
+    if not session_state_valid(session_state):
+        LOGGER.warning("Ignoring session stored in %s, it is not a stored session", COOKIES_FILE)
+        return None
+    return session_state
+
+
+def session_state_valid(session_state):
+    # any well formed json parses, only what share_session and restore_session can use is a session
+    return (isinstance(session_state, dict) and isinstance(session_state.get('user_agent'), str)
+            and isinstance(session_state.get('cookies'), list)
+            and all(isinstance(c, dict) and isinstance(c.get('name'), str) and isinstance(c.get('value'), str)
+                    for c in session_state['cookies']))
+
+
+def store_session(session_state):
+    # written to a new file only the owner can read and renamed over the old one, truncating a file that is
+    # already there would keep its owner and permissions
+    path = None
+    try:
+        fd, path = tempfile.mkstemp(prefix=".kita.", suffix=".cookies",
+                                    dir=os.path.dirname(os.path.abspath(COOKIES_FILE)))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(session_state, f)
+        os.replace(path, COOKIES_FILE)
+        path = None
+    except OSError as e:
+        # the stored session only saves the next run a sign in, this one goes on without it
+        LOGGER.warning("Could not store the session in %s: %s", COOKIES_FILE, e)
+    finally:
+        if path is not None:
+            os.remove(path)
 
 
-def add_date_to_exif(image, day):
-    image_file = Image.open(image)
-    exif_dict = piexif.load(image_file.info["exif"])
-    exif_dict["0th"][piexif.ImageIFD.DateTime] = day.strftime("%Y:%m:%d %H:%M:%S")
-    exif_bytes = piexif.dump(exif_dict)
-    image_file.save(image, exif=exif_bytes)
+def signed_in_session(check_url):
+    session_state = stored_session()
+    if session_state is not None and session_valid(session_state, check_url):
+        LOGGER.info("Reusing session stored in %s", COOKIES_FILE)
+        return session_state
+    driver, wait = setup_driver()
+    login(driver, wait, "{}/sessions/sign_in".format(BASE_URL), EMAIL, PASSWORD)
+    session_state = {'cookies': driver.get_cookies(), 'user_agent': driver.execute_script("return navigator.userAgent")}
+    driver.quit()
+    store_session(session_state)
+    return session_state
+
+
+def restore_session(driver, session_state):
+    # cookies can only be set for the domain of the currently loaded page
+    driver.get(BASE_URL)
+    for c in session_state['cookies']:
+        driver.add_cookie(c)
+
+
+def scrap_days(days, session_state, media_queue):
+    stats = Stats()
+    share_session(HTTP_SESSION, session_state)
+    driver = None  # only started for the first day which can not be scraped over plain http
+    over_http = True  # until the browser finds media plain http missed, then the site renders it with javascript
+    try:
+        for day in days:
+            stats.add(days=1)
+            LOGGER.info("Scraping %s day view for group %s", day.iso, GROUP_ID)
+            scraped = scrap_over_http(day.view_url) if over_http else None
+            if scraped is None:
+                if driver is None:
+                    driver, wait = setup_driver()
+                    restore_session(driver, session_state)
+                navigate_to_day(driver, wait, day.iso, day.view_url)
+                scraped = scrap_for_images_url(driver, wait)
+                if scraped[1] or scraped[2]:
+                    over_http = False  # the following days skip a day view request bound to come back unusable
+            for url in record_day(stats, *scraped):
+                media_queue.put((day, url))
+    finally:
+        media_queue.put(None)  # tells the downloader this worker is done, also when it failed
+        if driver is not None:
+            driver.quit()
+        HTTP_SESSION.close()
+    return stats
+
+
+def setup_logging():
+    # also the pool initializer, spawned browser workers don't inherit the parent's handlers, only this script
+    # follows LOG_LEVEL, at DEBUG selenium and urllib3 would log the password, cookies and signed media urls
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    LOGGER.setLevel(LOG_LEVEL)
 
 
 def scrap_site():
     global DAY_FROM, DAY_TO
-    if not os.path.exists(OUTPUT_DIR):
-        os.makedirs(OUTPUT_DIR)
+    setup_logging()
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
     if not DAY_TO:
         DAY_TO = datetime.now().strftime("%Y-%m-%d")
     if not DAY_FROM:
         DAY_FROM = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
-    driver = setup_driver()
-    login(driver, "{}/sessions/sign_in".format(BASE_URL), EMAIL, PASSWORD)
-    photos_count = 0
-    days_count = 0
-    for day in work_week_days(DAY_FROM, DAY_TO):
-        days_count = days_count + 1
-        navigate_to_day(driver, day)
-        photos_url = scrap_for_images_url(driver)
-        download_images(day, photos_url)
-        photos_count = photos_count + len(photos_url)
-    driver.quit()
-    print("Summary:")
-    print("\tChecked {} days between {} and {}".format(days_count, DAY_FROM, DAY_TO))
-    print("\tVisited {} journal entries".format(JOURNAL_ENTRIES_COUNT))
-    print("\tFound {} images in galleries and {} files in attachments".format(GALLERY_IMAGES_COUNT,
-                                                                              ATTACHMENTS_FILES_COUNT))
-    print("\tDownloaded {} files".format(photos_count))
+    if not GRID_URL:
+        geckodriver_path()
+    days = plan_days(DAY_FROM, DAY_TO)
+    # every day view is independent, deal them out round robin so each browser gets a similar share
+    chunks = [c for c in (days[i::BROWSERS] for i in range(BROWSERS)) if c]
+    stats = Stats()
+    if chunks:
+        # sign in once, every browser worker starts from the same session
+        session_state = signed_in_session(days[0].view_url)
+        share_session(HTTP_SESSION, session_state)
+        with Manager() as manager, ProcessPoolExecutor(max_workers=len(chunks), initializer=setup_logging) as pool:
+            media_queue = manager.Queue()
+            scrapers = [pool.submit(scrap_days, c, session_state, media_queue) for c in chunks]
+            download_media(media_queue, scrapers, stats)
+            # raises BrokenProcessPool once the media found so far is downloaded, when a worker died
+            stats = sum((s.result() for s in scrapers), stats)
+        HTTP_SESSION.close()
+    LOGGER.info("Summary:")
+    LOGGER.info("\tChecked %d days between %s and %s", stats.days, DAY_FROM, DAY_TO)
+    LOGGER.info("\tVisited %d journal entries", stats.entries)
+    LOGGER.info("\tFound %d images in galleries and %d files in attachments", stats.images, stats.attachments)
+    LOGGER.info("\tDownloaded %d files, %d failed", stats.downloaded, stats.failed)
+    LOGGER.info("\tCopied %d files found more than once instead of downloading them again", stats.duplicates)
 
 
-scrap_site()
+if __name__ == "__main__":
+    scrap_site()